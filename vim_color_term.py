@@ -25,11 +25,17 @@ import re
 import os
 import sys
 import glob
-import math
+import json
+import mmap
 import random
+import shutil
+import hashlib
 import argparse
+import functools
+import tempfile
 import subprocess
 from pathlib import Path
+from itertools import chain
 
 ### ----------------------------- Adjust-as-needed constants --------------------------------- ###
 # Adjust this accordingly or install the terminus fonts via Debian/Ubuntu 'xfonts-terminus' package
@@ -107,31 +113,27 @@ GOOD_ONES = [
 # Vim color schemes directory in which to search for GOOD_ONES
 GOOD_ONES_VIM_COLORS_DIR = '{0}/.vim/colors'.format(Path.home())
 
-# This maps the particular color scheme elements to ANSI and extended xterm color codes
+# This maps the particular color scheme elements (highlight group and gui color attribute) to ANSI
+# and extended xterm color codes
 # Adjust as needed to make mappings more sensible; this mostly works
-MAPPINGS = {
-    'foreground': r'.*Normal.*?guifg=([#\w]+).*',
-    'background': r'.*Normal.*?guibg=([#\w]+).*',
-
-    'color0': r'.*Comment.*?guifg=([#\w]+).*',      # <ESC>[30m (black)
-    'color1': r'.*ErrorMsg.*?guifg=([#\w]+).*',     # <ESC>[31m (red)
-    'color2': r'.*Type.*?guifg=([#\w]+).*',         # <ESC>[32m (green)
-    'color3': r'.*WarningMsg.*?guifg=([#\w]+).*',   # <ESC>[33m (yellow)
-    'color4': r'.*PreProc.*?guifg=([#\w]+).*',      # <ESC>[34m (blue)
-    'color5': r'.*Special.*?guifg=([#\w]+).*',      # <ESC>[35m (magenta)
-    'color6': r'.*Search.*?guifg=([#\w]+).*',       # <ESC>[36m (cyan)
-    'color7': r'.*Todo.*?guifg=([#\w]+).*',         # <ESC>[37m (white)
-
-    'color8': r'.*Comment.*?guifg=([#\w]+).*',      # black
-    'color9': r'.*ErrorMsg.*?guifg=([#\w]+).*',     # red
-    'color10': r'.*Type.*?guifg=([#\w]+).*',        # green
-    'color11': r'.*WarningMsg.*?guifg=([#\w]+).*',  # yellow
-    'color12': r'.*PreProc.*?guifg=([#\w]+).*',     # blue
-    'color13': r'.*Special.*?guifg=([#\w]+).*',     # magenta
-    'color14': r'.*Search.*?guifg=([#\w]+).*',      # cyan
-    'color15': r'.*Todo.*?guifg=([#\w]+).*'         # white
+GROUP_TO_RESOURCES = {
+    ('Normal', 'fg'): ('foreground',),
+    ('Normal', 'bg'): ('background',),
+
+    ('Comment', 'fg'): ('color0', 'color8'),        # <ESC>[30m (black)
+    ('ErrorMsg', 'fg'): ('color1', 'color9'),       # <ESC>[31m (red)
+    ('Type', 'fg'): ('color2', 'color10'),          # <ESC>[32m (green)
+    ('WarningMsg', 'fg'): ('color3', 'color11'),    # <ESC>[33m (yellow)
+    ('PreProc', 'fg'): ('color4', 'color12'),       # <ESC>[34m (blue)
+    ('Special', 'fg'): ('color5', 'color13'),       # <ESC>[35m (magenta)
+    ('Search', 'fg'): ('color6', 'color14'),        # <ESC>[36m (cyan)
+    ('Todo', 'fg'): ('color7', 'color15')           # <ESC>[37m (white)
 }
 
+# Parsed vim color scheme files and vim named colors are cached here between runs
+CACHE_DIR = '{0}/vim_color_term'.format(\
+    os.environ.get('XDG_CACHE_HOME', '{0}/.cache'.format(Path.home())))
+
 # Color scheme to show if all else fails; think a tasty cherry milkshake
 FAILSAFE_COLOR_SCHEME = {
     "background": "#fbe7eb",
@@ -163,6 +165,25 @@ KITTY_OPTIONS_PREFIX = '-o'
 XTERM_COMMAND = 'xterm'
 XTERM_XRESOURCES_PREFIX = '-xrm'
 
+# Generated options are given in this fixed order
+RESOURCES = tuple(chain.from_iterable(GROUP_TO_RESOURCES.values()))
+
+# A single pass over a file finds every mapped highlight group along with its guifg and guibg values
+# on the same line; it is a bytes pattern so the file needn't be decoded
+# The color values are only looked for up to the end of that highlight command ('|' or newline)
+HIGHLIGHT_REGEX = re.compile(\
+    (r'(?P<group>{0})'\
+     r'(?:(?=[^|\n]*?guifg=(?P<fg>[#\w]+)))?(?:(?=[^|\n]*?guibg=(?P<bg>[#\w]+)))?').format(\
+    '|'.join(re.escape(group) for group in\
+        sorted({group for (group, _) in GROUP_TO_RESOURCES}, key=len, reverse=True))).encode())
+HEX_REGEX = re.compile('#([0-9a-f]{6})')
+
+# Bump this whenever parsing changes so stale cache entries are no longer used; cache entries live
+# in a directory per version and script modification time so edits to the constants above take
+# effect, and the directories of other versions are removed once this one is created
+CACHE_VERSION = 5
+CACHE_VERSION_DIR = '{0}/{1}-{2}'.format(CACHE_DIR, CACHE_VERSION, os.stat(__file__).st_mtime_ns)
+
 # If not set, try to guess the VIMRUNTIME
 if not VIMRUNTIME:
     VIMRUNTIME_GLOB = glob.glob('/usr/share/vim/vim[78][0-9]')
@@ -172,82 +193,239 @@ if not VIMRUNTIME:
         sys.exit(\
             'ERROR: failed to find vim runtime; (set VIMRUNTIME to proper value or install vim)')
 
-NAMED_COLORS = {}
+RGB_FILE = VIMRUNTIME + '/rgb.txt'
+
+# Loaded on first use since many color schemes only use hex colors
+NAMED_COLORS = None
+
+# Set whenever the named colors are looked up, so cached options know if they depend on rgb.txt
+NAMED_COLORS_USED = False
+
+def cache_path(*key):
+    """
+    Get the path of the cache file holding the value for the given key
+    """
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()
+    return '{0}/{1}.json'.format(CACHE_VERSION_DIR, digest)
+
+
+def load_cached(path):
+    """
+    Load a cached value, returning None if there isn't a usable one
+    """
+    try:
+        with open(path, 'r') as cachefile:
+            return json.load(cachefile)
+    except (OSError, ValueError):
+        return None
+
+
+def prune_cache():
+    """
+    Remove everything in the cache other than the current version's directory
+    """
+    for name in os.listdir(CACHE_DIR):
+        path = '{0}/{1}'.format(CACHE_DIR, name)
+        if path == CACHE_VERSION_DIR:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def store_cached(path, value):
+    """
+    Atomically write a value to the cache; failures are ignored since the cache is only a speedup
+    """
+    try:
+        if not os.path.isdir(CACHE_VERSION_DIR):
+            os.makedirs(CACHE_VERSION_DIR, exist_ok=True)
+            prune_cache()
+        # pylint: disable=consider-using-with
+        cachefile = tempfile.NamedTemporaryFile('w', dir=CACHE_VERSION_DIR, delete=False)
+    except OSError:
+        return
+
+    try:
+        with cachefile:
+            json.dump(value, cachefile)
+        os.replace(cachefile.name, path)
+    except OSError:
+        # Don't leave the temporary file behind
+        try:
+            os.remove(cachefile.name)
+        except OSError:
+            pass
+
+
+def rgb_file_mtime():
+    """
+    Get the modification time of the vim rgb.txt file or None if it's missing
+    """
+    try:
+        return os.stat(RGB_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+def cached_options(function):
+    """
+    Cache the options generated from a vim color scheme file, or the error it failed with, keyed
+    by its path and the options and option format; an entry is only used while the file's
+    modification time and, if named colors were used, rgb.txt's modification time are unchanged
+    """
+    def options_or_error(entry):
+        if 'error' in entry:
+            raise Exception(entry['error'])
+        return entry['options']
+
+    @functools.wraps(function)
+    def wrapper(filename, options, option_format):
+        # pylint: disable=global-statement
+        global NAMED_COLORS_USED
+        mtime = os.stat(filename).st_mtime_ns
+        cache_file = cache_path(os.path.realpath(filename), options, option_format)
+        cached = load_cached(cache_file)
+        if cached is not None and cached['mtime'] == mtime and\
+                ('rgb_mtime' not in cached or cached['rgb_mtime'] == rgb_file_mtime()):
+            return options_or_error(cached)
+
+        NAMED_COLORS_USED = False
+        try:
+            entry = {'options': function(filename, options, option_format)}
+        except OSError:
+            # e.g. an unreadable file; that says nothing about its contents so it isn't cached
+            raise
+        # pylint: disable=broad-except
+        except Exception as ex:
+            entry = {'error': str(ex)}
+
+        entry['mtime'] = mtime
+        if NAMED_COLORS_USED:
+            entry['rgb_mtime'] = rgb_file_mtime()
+        store_cached(cache_file, entry)
+        return options_or_error(entry)
+
+    return wrapper
+
 
 def load_vim_named_colors():
     """
-    Load the mappings of vim colors to hex strings
+    Load the mappings of vim colors to hex strings; raises if rgb.txt can't be loaded so the color
+    scheme file needing them is skipped like any other bad file
     """
     try:
-        color_regex = re.compile(r'^\s*(\d+)\s+(\d+)\s+(\d+)\s+(.*)$')
-        with open(VIMRUNTIME + '/rgb.txt', 'r') as rgbfile:
+        mtime = os.stat(RGB_FILE).st_mtime_ns
+        cache_file = cache_path(RGB_FILE)
+        cached = load_cached(cache_file)
+        if cached is not None and cached['mtime'] == mtime:
+            return cached['named_colors']
+
+        named_colors = {}
+
+        with open(RGB_FILE, 'r') as rgbfile:
             for line in rgbfile:
-                color_matcher = color_regex.match(line)
-                if color_matcher is not None and color_matcher.groups(1) is not None:
-                    NAMED_COLORS[color_matcher.groups()[3].lower()] = \
-                        "{0:02x}{0:02x}{0:02x}".format(\
-                        *(int(color) for color in color_matcher.groups()[0:3]))
+                # Lines are "<red> <green> <blue> <name>"; anything else (e.g. comments) is skipped
+                fields = line.split(None, 3)
+                if len(fields) == 4 and fields[0].isdigit() and fields[1].isdigit() and\
+                        fields[2].isdigit():
+                    red, green, blue = map(int, fields[:3])
+                    named_colors[fields[3].rstrip().lower()] = bytes((red, green, blue)).hex()
+
+        store_cached(cache_file, {'mtime': mtime, 'named_colors': named_colors})
+        return named_colors
 
     # pylint: disable=broad-except
     except Exception as ex:
-        sys.exit("ERROR: failed to load vim rgb.txt: {0}".format(ex))
+        raise Exception("failed to load vim rgb.txt: {0}".format(ex)) from ex
 
 
-def color_distance(color_a_hex_string, color_b_hex_string):
+def get_vim_named_colors():
     """
-    Find some distance between two colors as an attempt to determine contrast
+    Get the mappings of vim colors to hex strings, loading them on first use
     """
-    color_a_tuple = (int(color_a_hex_string[:2], 16), int(color_a_hex_string[2:4], 16),\
-        int(color_a_hex_string[4:6], 16))
-    color_b_tuple = (int(color_b_hex_string[:2], 16), int(color_b_hex_string[2:4], 16),\
-        int(color_b_hex_string[4:6], 16))
-
-    rmean = (color_a_tuple[0] + color_b_tuple[0]) / 2
-    red = color_a_tuple[0] - color_b_tuple[0]
-    green = color_a_tuple[1] - color_b_tuple[1]
-    blue = color_a_tuple[2] - color_b_tuple[2]
-    return math.sqrt(((int(512+rmean) * red * red) >> 8) + 4 * green * green +\
-        ((int(767 - rmean) * blue * blue) >> 8))
+    # pylint: disable=global-statement
+    global NAMED_COLORS, NAMED_COLORS_USED
+    NAMED_COLORS_USED = True
+    if NAMED_COLORS is None:
+        NAMED_COLORS = load_vim_named_colors()
+    return NAMED_COLORS
+
+
+def color_distance_sq(color_a_rgb, color_b_rgb):
+    """
+    Find some squared distance between two colors as an attempt to determine contrast; the colors
+    are sequences of red, green and blue values, e.g. as given by bytes.fromhex()
+    """
+    red_a, green_a, blue_a = color_a_rgb
+    red_b, green_b, blue_b = color_b_rgb
+
+    # Stay in integer arithmetic; the red mean weights are rounded down and up respectively
+    red_sum = red_a + red_b
+    red = red_a - red_b
+    green = green_a - green_b
+    blue = blue_a - blue_b
+    return (((512 + (red_sum >> 1)) * red * red) >> 8) + 4 * green * green +\
+        (((767 - ((red_sum + 1) >> 1)) * blue * blue) >> 8)
 
 # pylint: disable=too-many-locals
 # pylint: disable=too-many-branches
+@cached_options
 def generate_options(filename, options, option_format):
     """
     Generate a list of options arguments expected by the terminals from a vim color scheme file
     """
     resource_hex_values = {}
-    compiled_mappings =\
-        {option: re.compile(this_regex) for (option, this_regex) in MAPPINGS.items()}
-    hex_regex = re.compile('#([0-9a-f]{6})')
-
-    for option, reggie in compiled_mappings.items():
-        with open(filename, 'r') as vimfile:
-            for line in vimfile:
-                matcher = reggie.match(line)
-                if matcher is not None and matcher.groups(1) is not None:
-                    vim_color_value = matcher.groups()[0].lower()
-                    if vim_color_value in NAMED_COLORS.keys():
-                        hex_value = NAMED_COLORS[vim_color_value]
-                    elif vim_color_value in ('fg', 'bg'):
-                        # set as "fg" or "bg" values for now, we'll
-                        # resolve these below once we're certain we have
-                        # valid values for foreground and background
-                        hex_value = vim_color_value
+
+    remaining_resources = dict(GROUP_TO_RESOURCES)
+
+    with open(filename, 'rb') as vimfile,\
+            mmap.mmap(vimfile.fileno(), 0, access=mmap.ACCESS_READ) as vimbuffer:
+        for matcher in HIGHLIGHT_REGEX.finditer(vimbuffer):
+            group = matcher.group('group').decode('ascii')
+            for kind in ('fg', 'bg'):
+                mapping_source = (group, kind)
+                if matcher.group(kind) is None or mapping_source not in remaining_resources:
+                    continue
+
+                vim_color_value = matcher.group(kind).decode('ascii').lower()
+                if vim_color_value in ('fg', 'bg'):
+                    # set as "fg" or "bg" values for now, we'll
+                    # resolve these below once we're certain we have
+                    # valid values for foreground and background
+                    hex_value = vim_color_value
+                elif vim_color_value.startswith('#'):
+                    hex_matcher = HEX_REGEX.match(vim_color_value)
+                    if hex_matcher is not None:
+                        hex_value = hex_matcher.group(1)
                     else:
-                        hex_matcher = hex_regex.match(vim_color_value)
-                        if hex_matcher is not None and hex_matcher.groups(1) is not None:
-                            hex_value = hex_matcher.groups()[0]
-                        else:
-                            raise Exception('invalid hex: ' + vim_color_value)
+                        raise Exception('invalid hex: ' + vim_color_value)
+                else:
+                    named_colors = get_vim_named_colors()
+                    if vim_color_value in named_colors:
+                        hex_value = named_colors[vim_color_value]
+                    else:
+                        raise Exception('invalid hex: ' + vim_color_value)
+
+                for resource in remaining_resources.pop(mapping_source):
+                    resource_hex_values[resource] = hex_value
 
-                    resource_hex_values[option] = hex_value
-                    break
+            if not remaining_resources:
+                break
+
+    # Bail out before adjusting anything if the Normal group didn't give both colors
+    if 'background' not in resource_hex_values or 'foreground' not in resource_hex_values:
+        raise Exception('no background or foreground color')
 
     # Adjust colors too close to background and set them to the foreground
     background_color = resource_hex_values['background']
     foreground_color = resource_hex_values['foreground']
-    if background_color is None or foreground_color is None:
-        raise Exception('no background or foreground color')
+
+    background_rgb = bytes.fromhex(background_color)
 
     for resource, color in resource_hex_values.items():
         if color == 'fg':
@@ -257,15 +435,12 @@ def generate_options(filename, options, option_format):
         elif resource != 'background':
             # This attempts to prevent a light foreground on a light background or a dark foreground
             # on a dark background but it doesn't work really well
-            distance = color_distance(color, background_color)
-            if distance < 10.0:
+            distance_sq = color_distance_sq(bytes.fromhex(color), background_rgb)
+            if distance_sq < 100:
                 resource_hex_values[resource] = foreground_color
 
-    if not resource_hex_values:
-        raise Exception('invalid format')
-
-    return options + sorted([option_format.format(resource, hex_value)\
-        for resource, hex_value in resource_hex_values.items()])
+    return options + [option_format.format(resource, resource_hex_values[resource])\
+        for resource in RESOURCES if resource in resource_hex_values]
 
 
 # pylint: disable=invalid-name
@@ -284,35 +459,45 @@ if __name__ == '__main__':
     VIM_FILES = PARSED_ARGS.vim_files if PARSED_ARGS.vim_files else\
         ['{0}/{1}.vim'.format(GOOD_ONES_VIM_COLORS_DIR, vim_file) for vim_file in GOOD_ONES]
 
-    GLOBBED_FILES = [item for sublist in [glob.glob(given_filename)\
-        for given_filename in VIM_FILES] for item in sublist]
+    GLOBBED_FILES = list(chain.from_iterable(glob.iglob(given_filename)\
+        for given_filename in VIM_FILES))
 
     random.shuffle(GLOBBED_FILES)
 
-    load_vim_named_colors()
+    if PARSED_ARGS.urxvt:
+        (TERM_COMMAND, OPTIONS_PREFIX, TERM_OPTIONS, OPTION_FORMAT) =\
+            (URXVT_COMMAND, URXVT_XRESOURCES_PREFIX, URXVT_XRESOURCES, 'URxvt*{0}: #{1}')
+    elif PARSED_ARGS.kitty:
+        (TERM_COMMAND, OPTIONS_PREFIX, TERM_OPTIONS, OPTION_FORMAT) =\
+            (KITTY_COMMAND, KITTY_OPTIONS_PREFIX, KITTY_OPTIONS, "{0}=#{1}")
+    else:
+        (TERM_COMMAND, OPTIONS_PREFIX, TERM_OPTIONS, OPTION_FORMAT) =\
+            (XTERM_COMMAND, XTERM_XRESOURCES_PREFIX, XTERM_XRESOURCES, "xterm*{0}: #{1}")
 
     command = []
-    term_environment = os.environ.copy()
+    # The terminal inherits this environment unchanged unless a color scheme is found
+    term_environment = None
+
+    last_error = 'no vim color scheme files found'
 
     for vim_file in GLOBBED_FILES:
         try:
-            if PARSED_ARGS.urxvt:
-                raw_options = [[URXVT_XRESOURCES_PREFIX, option] for option in generate_options(vim_file, URXVT_XRESOURCES, 'URxvt*{0}: #{1}')]
-                command = [URXVT_COMMAND] + [option for squashed in raw_options for option in squashed]
-            elif PARSED_ARGS.kitty:
-                raw_options = [[KITTY_OPTIONS_PREFIX, option] for option in generate_options(vim_file, KITTY_OPTIONS, "{0}=#{1}")]
-                command = [KITTY_COMMAND] + [option for squashed in raw_options for option in squashed]
-            else:
-                raw_options = [[XTERM_XRESOURCES_PREFIX, option] for option in generate_options(vim_file, XTERM_XRESOURCES, "xterm*{0}: #{1}")]
-                command = [XTERM_COMMAND] + [option for squashed in raw_options for option in squashed]
+            generated_options = generate_options(vim_file, TERM_OPTIONS, OPTION_FORMAT)
+        # pylint: disable=broad-except
+        except Exception as ex:
+            # Ignore crap file and try another
+            last_error = '{0}: {1}'.format(vim_file, ex)
+            continue
 
-            term_environment[ENV_COLOR_SCHEME_NAME_VAR] = vim_file
+        command = [TERM_COMMAND, *chain.from_iterable((OPTIONS_PREFIX, option)\
+            for option in generated_options)]
+        term_environment = os.environ.copy()
+        term_environment[ENV_COLOR_SCHEME_NAME_VAR] = vim_file
 
-            break
-        # pylint: disable=bare-except
-        except:
-            # Ignore crap file and try another
-            pass
+        break
+
+    if not command:
+        sys.exit("ERROR: no usable vim color scheme file; last error: {0}".format(last_error))
 
     print("command: ", command)
 